@@ -0,0 +1,64 @@
+"""Minimal ctypes wrapper for Linux inotify, to wake up when logs are written"""
+import ctypes
+import os
+import select
+import struct
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+
+_event_header = struct.Struct('iIII')  # wd, mask, cookie, len(name)
+
+
+class INotify:
+    """Watch files for changes. Raises OSError where inotify is unavailable."""
+    def __init__(self):
+        # Symbols from the already loaded libc; find_library() would run ldconfig
+        libc = ctypes.CDLL(None, use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError("inotify is not available on this platform")
+        if fd < 0:
+            _raise_errno()
+        self.fd = fd
+
+    def add_watch(self, path, mask=IN_MODIFY | IN_CLOSE_WRITE):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            _raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails if the watch is already gone (e.g. file deleted); that's fine
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Wait up to timeout seconds for events
+
+        Returns the set of watch descriptors with events (empty on timeout).
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+
+        wds, pos = set(), 0
+        while pos < len(buf):
+            wd, _, _, name_len = _event_header.unpack_from(buf, pos)
+            wds.add(wd)
+            pos += _event_header.size + name_len
+        return wds
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _raise_errno(filename=None):
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err), filename)
@@ -1,12 +1,15 @@
 import argparse
-import itertools
 import os
 import re
+import stat
 import sys
 import time
 from collections import defaultdict
-from subprocess import run, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from subprocess import check_output, PIPE
 
+from .inotify import INotify
 from .terminal import msg, spinner_msg, clear_spinner, fmt_state, fmt_jobs
 
 
@@ -14,95 +17,269 @@ class UsageError(Exception):
     pass
 
 
-STATES_FINISHED = {  # https://slurm.schedmd.com/squeue.html#lbAG
+STATES_FINISHED = frozenset({  # https://slurm.schedmd.com/squeue.html#lbAG
     'BOOT_FAIL',  'CANCELLED', 'COMPLETED',  'DEADLINE', 'FAILED',
     'NODE_FAIL', 'OUT_OF_MEMORY', 'PREEMPTED', 'SPECIAL_EXIT', 'TIMEOUT',
-}
-STATES_NOT_STARTED = {'PENDING', 'CONFIGURING'}
+})
+STATES_NOT_STARTED = frozenset({'PENDING', 'CONFIGURING'})
+
+# 'job_id state' lines from squeue
+_SQUEUE_RE = re.compile(r'^[ \t]*(\S+)[ \t]+(\S+)', re.M)
+
+# Key=Value pairs from scontrol. Values may contain spaces (e.g. paths), so
+# each one runs until whitespace followed by the next key.
+_KV_RE = re.compile(r'(?<!\S)([A-Za-z:]+)=(.*?)(?=\s+[A-Za-z:]+=|\s*\Z)', re.S)
+
+# Each squeue call is a round trip to the Slurm controller, so poll job states
+# less often while nothing is happening (no state changes or new output).
+STATE_POLL_MIN = 2   # seconds
+STATE_POLL_MAX = 30
+
+# inotify doesn't see writes from other nodes on network filesystems, so we
+# also read all the log files this often (seconds).
+LOG_POLL_INTERVAL = 0.5
+# Don't handle inotify events more often than this (seconds), so a burst of
+# small writes is read & written out in one go, not one wake-up per write.
+MIN_WAKE_INTERVAL = 0.05
+
+READ_CHUNK = 1 << 20  # Min. bytes per read() call; larger if st_blksize is
+PARTIAL_LINE_WAIT = 0.5  # seconds to hold back output without a newline
+
+def slurm_output(cmd, cluster=None):
+    """Run a Slurm command & return its output"""
+    if cluster is not None:
+        cmd = cmd + ['--clusters', cluster]
+    # Read the output as bytes & decode it in one go
+    return check_output(cmd, stderr=PIPE).decode('utf-8')
+
 
 def job_states(job_ids, cluster=None):
     cmd = ['squeue', '--noheader', '--format=%i %T', '--jobs', ','.join(job_ids), '--states=all']
-    if cluster is not None:
-        cmd += ['--clusters', cluster]
-    res = run(cmd, stdout=PIPE, stderr=PIPE, encoding='utf-8', check=True)
-    return dict([l.strip().partition(' ')[::2] for l in res.stdout.splitlines()])
+    out = slurm_output(cmd, cluster=cluster)
+    # Interned, the same few states compare by identity in set lookups
+    return {
+        sys.intern(job_id): sys.intern(state)
+        for job_id, state in _SQUEUE_RE.findall(out)
+    }
 
 
 def sfollow(job_ids, cluster=None):
     states = job_states(job_ids, cluster=cluster)
-    open_files = defaultdict(list)
+    read_sizes = {}  # fd of each open log file -> bytes per read() call
+    job_fds = defaultdict(list)  # job ID -> fds of its log files
+    partial_lines = {}  # fd -> (output after the last newline, time held)
+    watches = {}  # fd -> inotify watch descriptor
+
+    try:
+        notifier = INotify()
+    except OSError:
+        notifier = None  # Not Linux, just poll the files
+
+    def open_log(jid, path):
+        # Plain fds: we read big chunks, so Python's buffering doesn't help
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC | os.O_NONBLOCK)
+        if notifier is not None:
+            try:
+                watches[fd] = notifier.add_watch(path)
+            except OSError:
+                pass  # e.g. out of watches (ENOSPC); the periodic scan reads it
+        if hasattr(os, 'posix_fadvise'):  # Not on macOS
+            try:  # Logs are read start to end: let the kernel read ahead more
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass  # Only a hint, e.g. not supported for pipes
+        # Parallel filesystems (GPFS, Lustre) prefer large I/O, and report
+        # their preferred size as st_blksize.
+        read_sizes[fd] = max(os.fstat(fd).st_blksize, READ_CHUNK)
+        job_fds[jid].append(fd)
+        return fd
 
     def finished(jid, final_state):
         # Job finished since the last check
-        for fh in open_files.pop(jid, ()):
-            # strip any trailing newline, let print() add one.
-            b = fh.read()
+        out = bytearray()
+        for fd in job_fds.pop(jid, ()):
+            held, _ = partial_lines.pop(fd, (b'', None))
+            b = held + read_new(fd, read_sizes.pop(fd))
             if b:
-                print(b.decode('utf-8', 'replace').rstrip('\n'))
-            fh.close()
+                # Ensure a newline at the end before our message
+                out += b.rstrip(b'\n') + b'\n'
+            if fd in watches:
+                wd = watches.pop(fd)
+                # inotify gives the same watch for the same file, which
+                # another job we're following may also be writing to.
+                if wd not in watches.values():
+                    notifier.rm_watch(wd)
+            os.close(fd)
+        write_out(out)
 
         msg(f'Job {jid} finished ({fmt_state(final_state)})')
 
     # Jobs already running before we started: jump to near the end, like tail -f
-    for job_id, state in states.items():
-        if state not in STATES_NOT_STARTED:
-            info = get_job_info(job_id, cluster=cluster)
-            for path in get_std_streams(info):
-                fh = open(path, 'rb')
-                if os.stat(fh.fileno()).st_size > 512:
-                    fh.seek(-512, os.SEEK_END)
-                open_files[job_id].append(fh)
-
-            if state in STATES_FINISHED:
-                finished(job_id, state)
-
-    for i in itertools.count():
-        for files in open_files.values():
-            for f in files:
-                for line in f:
-                    print(line.decode('utf-8', 'replace'), end='')
-
-        # Check for jobs started/finished every 4th cycle (2 seconds)
-        if i % 4 == 0:
-            if not open_files:
-                spinner_msg(f"Waiting for {fmt_jobs(job_ids)} to start")
-
-            new_states = job_states([
-                j for (j, s) in states.items() if s not in STATES_FINISHED
-            ], cluster=cluster)
+    running = [j for (j, s) in states.items() if s not in STATES_NOT_STARTED]
+    for job_id, info in get_job_infos(running, cluster=cluster).items():
+        for path in get_std_streams(info):
+            seek_last_lines(open_log(job_id, path))
+
+        if states[job_id] in STATES_FINISHED:
+            finished(job_id, states[job_id])
+
+    # Kept up to date as states change, so we don't rescan all jobs each time
+    unfinished = {j for (j, s) in states.items() if s not in STATES_FINISHED}
+
+    waiting_msg = f"Waiting for {fmt_jobs(job_ids)} to start"
+    last_change = time.monotonic()
+    next_poll = last_change + STATE_POLL_MIN
+    last_scan = 0
+    changed_wds = set()
+
+    while True:
+        now = time.monotonic()
+        # Read files with inotify events, plus all of them periodically
+        scan_all = notifier is None or now - last_scan >= LOG_POLL_INTERVAL
+        if scan_all:
+            last_scan = now
+
+        # Collect new output from the files to write out in one go. This is
+        # the only write & flush per wake-up, and wake-ups are at least
+        # MIN_WAKE_INTERVAL apart, so we don't need to throttle flushing.
+        out = bytearray()
+        for fd, read_size in read_sizes.items():
+            if not (scan_all or watches.get(fd) in changed_wds):
+                continue
+            held, since = partial_lines.pop(fd, (b'', now))
+            b = held + read_new(fd, read_size)
+            # Write complete lines, so output from several files isn't
+            # interleaved mid-line. Hold back the rest briefly in case the
+            # line is finished soon, but not forever (e.g. prompts).
+            i = max(b.rfind(b'\n'), b.rfind(b'\r')) + 1
+            if i < len(b) and now - since < PARTIAL_LINE_WAIT:
+                partial_lines[fd] = (b[i:], since if i == 0 else now)
+                b = b[:i]
+            out += b
+        if out:
+            write_out(out)
+            last_change = now
+
+        if not job_fds:  # No job has log files open
+            spinner_msg(waiting_msg)
+
+        # Check for jobs started/finished, backing off while things are quiet
+        if now >= next_poll:
+            new_states = job_states(list(unfinished), cluster=cluster)
         else:
             new_states = {}
 
+        # Look up all jobs started since the last check together
+        infos = get_job_infos([
+            j for (j, s) in new_states.items()
+            if s not in STATES_NOT_STARTED and states[j] in STATES_NOT_STARTED
+        ], cluster=cluster)
+
         for job_id, new_state in new_states.items():
-            started = new_state not in STATES_NOT_STARTED
-            if started and states[job_id] in STATES_NOT_STARTED:
+            if new_state != states[job_id]:
+                last_change = now
+
+            if job_id in infos:
                 # Job started since the last check
-                info = get_job_info(job_id, cluster=cluster)
+                info = infos[job_id]
                 clear_spinner()
                 msg(f"Job {job_id} ({info.get('JobName', '')}) started")
                 for path in get_std_streams(info):
-                    open_files[job_id].append(open(path, 'rb'))
+                    open_log(job_id, path)
 
             if new_state in STATES_FINISHED:
                 finished(job_id, new_state)
+                unfinished.discard(job_id)
 
             states[job_id] = new_state
 
-        if all(st in STATES_FINISHED for st in states.values()):
+        if not unfinished:
             break  # All jobs finished, sfollow can exit
 
-        time.sleep(0.5)
+        if now >= next_poll:
+            idle = now - last_change
+            next_poll = now + min(STATE_POLL_MAX, max(STATE_POLL_MIN, idle / 5))
+
+        # Wait for a log file to be written to, or time to check them all
+        if notifier is None:
+            time.sleep(LOG_POLL_INTERVAL)
+        else:
+            # Polling squeue may have taken a while, so check the time again
+            next_scan = last_scan + LOG_POLL_INTERVAL
+            changed_wds = notifier.read(
+                timeout=max(0, next_scan - time.monotonic())
+            )
+            if changed_wds:
+                time.sleep(max(0, now + MIN_WAKE_INTERVAL - time.monotonic()))
+                changed_wds |= notifier.read(timeout=0)  # Events while we slept
+
+    if notifier is not None:
+        notifier.close()
+
+
+def seek_last_lines(fd, n=5, max_bytes=65536):
+    """Move to the start of the last n lines of a file, like tail
+
+    Looks back at most max_bytes from the end, reading backwards in blocks.
+    Other kinds of file (e.g. FIFOs) can't seek, so they're left as they are.
+    """
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return
+    end = os.lseek(fd, 0, os.SEEK_END)
+    limit = max(0, end - max_bytes)
+    pos = max(limit, end - 4096)
+    buf = os.pread(fd, end - pos, pos)
+    # A newline as the last byte ends the last line, so don't count it
+    while buf.count(b'\n', 0, len(buf) - 1) < n and pos > limit:
+        prev_pos, pos = pos, max(limit, pos - 4096)
+        buf = os.pread(fd, prev_pos - pos, pos) + buf
+
+    i = len(buf) - 1
+    for _ in range(n):
+        i = buf.rfind(b'\n', 0, i)
+        if i < 0:
+            break  # Fewer than n lines: start from the beginning (or limit)
+    os.lseek(fd, pos + i + 1, os.SEEK_SET)
+
+
+def read_new(fd, size=READ_CHUNK):
+    """Read everything written to a log file since we last read it"""
+    chunks = []
+    while True:
+        try:
+            b = os.read(fd, size)
+        except BlockingIOError:  # Output is going to a FIFO
+            b = b''
+        chunks.append(b)
+        if len(b) < size:  # Short read: we've caught up with the writer
+            return b''.join(chunks)
+
+
+def write_out(b):
+    """Pass log output through to stdout as bytes, without decoding it"""
+    if b:
+        sys.stdout.buffer.write(b)
+        sys.stdout.flush()
 
 
 def get_job_info(job_id, cluster=None):
     """Return a dict of job info from 'scontrol show job'"""
     cmd = ['scontrol', 'show', 'job', str(job_id)]
-    if cluster is not None:
-        cmd += ['--clusters', cluster]
-    out = run(cmd, stdout=PIPE, stderr=PIPE, encoding='utf-8', check=True)
+    return dict(_KV_RE.findall(slurm_output(cmd, cluster=cluster)))
 
-    kvlist = re.split(r'(?:^|\s+)([A-Za-z:]+)=', out.stdout.strip())[1:]
-    return dict(zip(kvlist[::2], kvlist[1::2]))
+
+def get_job_infos(job_ids, cluster=None):
+    """Return a dict of job info dicts, keyed by job ID
+
+    'scontrol show job' only takes one job ID, so this is one call per job.
+    With several jobs, the calls run in parallel threads.
+    """
+    if len(job_ids) <= 1:
+        return {j: get_job_info(j, cluster=cluster) for j in job_ids}
+
+    with ThreadPoolExecutor(max_workers=min(16, len(job_ids))) as pool:
+        infos = pool.map(partial(get_job_info, cluster=cluster), job_ids)
+        return dict(zip(job_ids, infos))
 
 
 def get_std_streams(job_info):
@@ -116,7 +293,10 @@ def get_std_streams(job_info):
     if 'StdErr' in job_info:
         paths.append(job_info['StdErr'])
 
-    if len(paths) == 2 and os.path.samefile(paths[0],  paths[1]):
+    # Comparing the strings first saves stat() calls in the common case
+    if len(paths) == 2 and (
+            paths[0] == paths[1] or os.path.samefile(paths[0], paths[1])
+    ):
         # Stdout & stderr in the same file
         del paths[1]
 
@@ -127,15 +307,10 @@ def my_last_job(cluster=None):
     # '--format=%i %j' gives job IDs & names
     # --sort=-V sorts by submission time (descending)
     cmd = ['squeue', '--me', '--noheader', '--format=%i %j', '--sort=-V', '--states=all']
-    if cluster is not None:
-        cmd += ['--clusters', cluster]
-    res = run(
-        cmd, stdout=PIPE, stderr=PIPE, encoding='utf-8', check=True
-    )
-    my_jobs = res.stdout.splitlines()
+    my_jobs = slurm_output(cmd, cluster=cluster).splitlines()
     if not my_jobs:
         raise UsageError("You have no jobs running or recently finished")
-    return my_jobs[0].strip().split(maxsplit=1)
+    return my_jobs[0].split(maxsplit=1)
 
 
 def main():
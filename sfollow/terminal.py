@@ -1,5 +1,5 @@
 import sys
-from shutil import get_terminal_size
+import time
 
 def fmt_jobs(job_ids):
     if len(job_ids) == 1:
@@ -19,21 +19,26 @@ def fmt_state(state):
 def msg(s):
     print('[sfollow]', s, file=sys.stderr)
 
-spinner_i = 0
 spinner_parts = '|/-\\'
+spinner_step = 0.5  # seconds per spinner frame
+spinner_frame = 0
 spinner_shown = False
 
 def spinner_msg(s):
-    global spinner_i, spinner_shown
-    c = spinner_parts[spinner_i]
+    global spinner_frame, spinner_shown
+    # Animate by the clock, so calling this more often doesn't redraw more
+    frame = int(time.monotonic() / spinner_step)
+    if spinner_shown and frame == spinner_frame:
+        return
+    c = spinner_parts[frame % len(spinner_parts)]
     print('[sfollow]', c, s, end='\r', file=sys.stderr)
 
     spinner_shown = True
-    spinner_i = (spinner_i + 1) % len(spinner_parts)
+    spinner_frame = frame
 
 def clear_spinner():
     global spinner_shown
     if spinner_shown:
-        cols, _ = get_terminal_size()
-        print(' ' * cols, end='\r')
+        # Erase the line, on stderr where the spinner was drawn
+        print('\x1b[2K\r', end='', file=sys.stderr)
         spinner_shown = False